@@ -1,194 +1,346 @@
 import streamlit as st
 from langgraph.graph import StateGraph, END
-from typing import Dict, Any, TypedDict
+from typing import Dict, Any, Optional, TypedDict
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 from langchain_groq import ChatGroq
-from datetime import datetime, timedelta
-import pytz
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import os
 import httpx
+import numpy as np
+import orjson
 import asyncio
 import re
+import threading
+from collections import OrderedDict
+from enum import IntFlag
 from dotenv import load_dotenv
-from dateutil import parser
 
 # --- LangGraph Agent Setup ---
 class AgentState(TypedDict):
     messages: list
     intent: str
-    suggested_slots: list
+    suggested_slots: list[tuple[str, datetime]]
+    slot_hours: np.ndarray
     confirmed_slot: str
     time_zone: str
     events: list
+    pending_slots: Optional[asyncio.Task]
+    history_str: str
+    user_flags: int
 
 load_dotenv()
 
 # Backend URL from environment variable
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")  # Default to local for testing
 
+class BackendClient:
+    """Pooled backend client bound to an event loop on its own daemon thread.
+
+    Each Streamlit run drives its own short-lived event loop, so requests are handed to
+    the background loop and awaited from the caller's loop; keep-alive connections are
+    reused across runs and sessions.
+    """
+
+    def __init__(self, base_url: str):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="backend-http", daemon=True).start()
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            http2=True,
+            timeout=30.0,
+        )
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        # Cancelling the awaiting task also cancels the request on the background loop
+        future = asyncio.run_coroutine_threadsafe(self._client.request(method, url, **kwargs), self._loop)
+        return await asyncio.wrap_future(future)
+
+@st.cache_resource
+def _backend_client() -> BackendClient:
+    """Process-wide backend client, shared across reruns and sessions."""
+    return BackendClient(BACKEND_URL)
+
+_HTTP = _backend_client()
+
 # Initialize Groq model
 llm = ChatGroq(model="llama-3.3-70b-versatile", api_key=os.getenv("GROQ_API_KEY"))
 
-# Define prompts (unchanged)
-intention_prompt = ChatPromptTemplate.from_template("""
-You are a conversational AI agent for booking appointments in India. Based on the user's message, identify their intent and return only the intent keyword. Possible intents are:
+IST = ZoneInfo("Asia/Kolkata")
+UTC = timezone.utc
+
+_TIME_RE = re.compile(r"(\d{1,2})(?::(\d{2}))?\s*(am|pm)")
+_DATE_RE = re.compile(r"(january|february|march|april|may|june|july|august|september|october|november|december)\s+(\d{1,2}),\s*(\d{4})")
+# Standalone numbers ("slot 2", "cancel 12"), excluding clock times like "3:30" or "4 pm"
+_NUMBER_RE = re.compile(r"(?<![:\d])\b(\d+)\b(?!\s*(?::\d|am\b|pm\b))")
+_MONTH_MAP = {
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6,
+    "july": 7, "august": 8, "september": 9, "october": 10, "november": 11, "december": 12
+}
+_DAY_RE = re.compile(r"\b(today|tomorrow|monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b")
+# Relative day names map to a fixed offset; weekday names to their weekday() index
+_DAY_OFFSETS = {"today": 0, "tomorrow": 1}
+_WEEKDAYS = {"monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3, "friday": 4, "saturday": 5, "sunday": 6}
+
+# Prior messages included in the suggestion and confirmation prompts
+HISTORY_LIMIT = 4
+
+INTENTS = ("book_appointment", "check_availability", "confirm_booking", "cancel", "unclear")
+
+class UserFlags(IntFlag):
+    """Keywords found in the user's message, computed once per turn by _classify()."""
+    ANYTIME = 1  # suggest_slots falls back to every business-hours slot
+    AFTERNOON = 2
+    MORNING = 4
+    GREETING = 8
+    CANCEL_WORD = 16
+    WHOLE_DAY = 32  # parse_user_date narrows the range to 9 AM-6 PM of the day
+
+_FLAG_RE = re.compile(r"\b(anytime|any time|whole day|all day|any slot|afternoon|good morning|hi|hello|hey|cancel)\b")
+_FLAG_WORDS = {
+    "anytime": UserFlags.ANYTIME, "any time": UserFlags.WHOLE_DAY,
+    "whole day": UserFlags.ANYTIME | UserFlags.WHOLE_DAY, "all day": UserFlags.ANYTIME | UserFlags.WHOLE_DAY,
+    "any slot": UserFlags.ANYTIME | UserFlags.WHOLE_DAY, "afternoon": UserFlags.AFTERNOON,
+    "good morning": UserFlags.MORNING, "hi": UserFlags.GREETING, "hello": UserFlags.GREETING,
+    "hey": UserFlags.GREETING, "cancel": UserFlags.CANCEL_WORD
+}
+
+def _classify(message: str) -> UserFlags:
+    """Scan a lower-cased message once and return the keyword flags it contains."""
+    flags = UserFlags(0)
+    for match in _FLAG_RE.finditer(message):
+        flags |= _FLAG_WORDS[match.group(1)]
+    return flags
+
+# Words suggesting a booking or availability request, used to decide whether to prefetch slots
+_AVAILABILITY_RE = re.compile(r"\b(book|schedule|free|available|availability|meeting|appointment)\b")
+
+# Ordinals and short answers whose meaning depends on the previous assistant turn
+_SELECTION_RE = re.compile(r"\b(first|second|third|fourth|fifth|last|one|yes|yeah|no|ok|okay|sure)\b")
+
+# Messages whose intent is obvious without asking the LLM
+_GREETING_RE = re.compile(r"^(hi|hello|hey)\W*$")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+class IntentCache:
+    """Thread-safe LRU mapping normalized user messages to intent labels."""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._labels: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        return _WHITESPACE_RE.sub(" ", message.strip().lower())
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            label = self._labels.get(key)
+            if label is not None:
+                self._labels.move_to_end(key)
+            return label
+
+    def add(self, key: str, label: str) -> None:
+        with self._lock:
+            self._labels[key] = label
+            self._labels.move_to_end(key)
+            if len(self._labels) > self.maxsize:
+                self._labels.popitem(last=False)
+
+@st.cache_resource
+def _intent_cache() -> IntentCache:
+    """Process-wide intent cache, shared across reruns and sessions."""
+    return IntentCache()
+
+# Define prompts. Static instructions go in the system message so every call shares the
+# same prompt prefix (and Groq's prefix cache); per-turn values go in the human message.
+intention_prompt = ChatPromptTemplate.from_messages([
+    ("system", """You are a conversational AI agent for booking appointments in India. Based on the user's message, identify their intent and return only the intent keyword. Possible intents are:
 - book_appointment
 - check_availability
 - confirm_booking
 - cancel
 - unclear
 
-User message: {message}
-Current conversation: {history}
-
-Respond with a single word: the identified intent.
-""")
+Respond with a single word: the identified intent."""),
+    ("human", """User message: {message}
+Current conversation: {history}""")
+])
 
-suggestion_prompt = ChatPromptTemplate.from_template("""
-You are a conversational AI agent for booking appointments in India. Suggest up to 5 available time slots in Asia/Kolkata time zone, formatted as human-readable dates/times (e.g., "June 26, 2025, 2:00 PM"). If the user specifies specific times (e.g., "4 PM", "12 PM", "7 PM") or requests 'any slot', 'anytime', 'whole day', or 'all day', prioritize checking those times first and then provide all available slots for the day between 9 AM and 6 PM if no exact match is found. Avoid repeating previous suggestions.
+suggestion_prompt = ChatPromptTemplate.from_messages([
+    ("system", """You are a conversational AI agent for booking appointments in India. Suggest up to 5 available time slots in Asia/Kolkata time zone, formatted as human-readable dates/times (e.g., "June 26, 2025, 2:00 PM"). If the user specifies specific times (e.g., "4 PM", "12 PM", "7 PM") or requests 'any slot', 'anytime', 'whole day', or 'all day', prioritize checking those times first and then provide all available slots for the day between 9 AM and 6 PM if no exact match is found. Avoid repeating previous suggestions.
 
-User message: {message}
+Respond with a natural language message suggesting up to 5 time slots or asking for clarification if needed."""),
+    ("human", """User message: {message}
 Available slots (Asia/Kolkata): {slots}
-Current conversation: {history}
+Current conversation: {history}""")
+])
 
-Respond with a natural language message suggesting up to 5 time slots or asking for clarification if needed.
-""")
+confirmation_prompt = ChatPromptTemplate.from_messages([
+    ("system", """You are a conversational AI agent in India. Confirm the booking details in Asia/Kolkata time zone, formatted as human-readable (e.g., "June 26, 2025, 2:00 PM").
 
-confirmation_prompt = ChatPromptTemplate.from_template("""
-You are a conversational AI agent in India. Confirm the booking details in Asia/Kolkata time zone, formatted as human-readable (e.g., "June 26, 2025, 2:00 PM").
-
-Example output:
+Respond with a confirmation message including the booking details."""),
+    ("human", """Example output:
 "Your appointment is confirmed for {slot} (Asia/Kolkata). Thank you for booking!"
 
 Selected slot: {slot}
 User message: {selected_message}
-Current conversation: {history}
-
-Respond with a confirmation message including the booking details.
-""")
+Current conversation: {history}""")
+])
 
-cancel_prompt = ChatPromptTemplate.from_template("""
-You are a scheduling assistant AI in India. List upcoming events in Asia/Kolkata time zone and ask the user to select one by number to cancel.
-
-User message: {message}
-Upcoming events: {events}
-Current conversation: {history}
+cancel_prompt = ChatPromptTemplate.from_messages([
+    ("system", """You are a scheduling assistant AI in India. List upcoming events in Asia/Kolkata time zone and ask the user to select one by number to cancel.
 
 Example output:
 "Please select an event to cancel:\n1. Meeting at June 26, 2025, 10:00 AM\n2. Appointment at June 27, 2025, 3:00 PM"
 
-Respond with a message listing events with their indices or confirming cancellation.
-""")
-
-def identify_intent(state: AgentState) -> AgentState:
+Respond with a message listing events with their indices or confirming cancellation."""),
+    ("human", """User message: {message}
+Upcoming events: {events}
+Current conversation: {history}""")
+])
+
+async def _stream_reply(prompt: list, config: RunnableConfig) -> str:
+    """Stream an LLM reply into the pending assistant bubble, if any, and return the full text."""
+    reply_box = config.get("configurable", {}).get("reply_box")
+    text = ""
+    async for chunk in llm.astream(prompt):
+        text += chunk.content
+        if reply_box is not None:
+            reply_box.markdown(f"**AI:** {text}")
+    return text.strip()
+
+async def identify_intent(state: AgentState) -> AgentState:
     """Identify the user's intent from their message."""
     message = state["messages"][-1]["content"]
-    history = "\n".join(msg["content"] for msg in state["messages"][:-1])
+    key = IntentCache.normalize(message)
+    if _GREETING_RE.match(key):
+        state["intent"] = "unclear"
+        return state
+    if state["user_flags"] & UserFlags.CANCEL_WORD:
+        state["intent"] = "cancel"
+        return state
+    cache = _intent_cache()
+    # Selections and single-word replies ("yes", "2 please", "the first one") mean confirm after
+    # slot suggestions but cancel after the event list, so they are never cached or looked up
+    cacheable = " " in key and not (_NUMBER_RE.search(key) or _SELECTION_RE.search(key))
+    cached = cache.get(key) if cacheable else None
+    if cached:
+        state["intent"] = cached
+        return state
+
+    # Look up availability while the LLM classifies, but only when the message looks like it
+    # wants slots; route() cancels the lookup if the intent turns out not to need it
+    lowered = message.strip().lower()
+    if _DAY_RE.search(lowered) or _DATE_RE.search(lowered) or _AVAILABILITY_RE.search(lowered):
+        state["pending_slots"] = asyncio.create_task(_fetch_slots(lowered, state["user_flags"]))
+        state["pending_slots"].add_done_callback(lambda task: task.cancelled() or task.exception())
+
     try:
-        response = llm.invoke(intention_prompt.format(message=message, history=history))
+        # Only the previous exchange matters for classifying intent
+        history = "\n".join(msg["content"] for msg in state["messages"][-3:-1])
+        response = await llm.ainvoke(intention_prompt.format_messages(message=message, history=history))
         state["intent"] = response.content.strip()
+        if state["intent"] in INTENTS and cacheable:
+            cache.add(key, state["intent"])
     except Exception as e:
         state["messages"].append({"error": f"Error processing request: {str(e)}. Please try again.", "role": "assistant"})
         state["intent"] = "unclear"
     return state
 
-def parse_user_date(message: str) -> tuple[datetime | None, datetime | None]:
+def parse_user_date(message: str, flags: int = 0) -> tuple[datetime | None, datetime | None]:
     """Parse the user's message to extract a specific date or time range."""
     message = message.lower()
-    now = datetime.now(pytz.UTC)
+    now = datetime.now(UTC)
     today = now.date()
     
-    day_map = {
-        "today": today,
-        "tomorrow": today + timedelta(days=1),
-        "monday": today + timedelta(days=(0 - today.weekday()) % 7),
-        "tuesday": today + timedelta(days=(1 - today.weekday()) % 7),
-        "wednesday": today + timedelta(days=(2 - today.weekday()) % 7),
-        "thursday": today + timedelta(days=(3 - today.weekday()) % 7),
-        "friday": today + timedelta(days=(4 - today.weekday()) % 7),
-        "saturday": today + timedelta(days=(5 - today.weekday()) % 7),
-        "sunday": today + timedelta(days=(6 - today.weekday()) % 7)
-    }
-    
     start_date = None
     end_date = None
-    for day, date in day_map.items():
-        if day in message:
-            start_date = datetime.combine(date, datetime.min.time(), tzinfo=pytz.UTC)
-            end_date = start_date + timedelta(days=1)
-            break
+    day_match = _DAY_RE.search(message)
+    if day_match:
+        day = day_match.group(1)
+        offset = _DAY_OFFSETS[day] if day in _DAY_OFFSETS else (_WEEKDAYS[day] - today.weekday()) % 7
+        start_date = datetime.combine(today + timedelta(days=offset), datetime.min.time(), tzinfo=UTC)
+        end_date = start_date + timedelta(days=1)
     
-    date_pattern = r"(january|february|march|april|may|june|july|august|september|october|november|december)\s+(\d{1,2}),\s*(\d{4})"
-    match = re.search(date_pattern, message)
+    match = _DATE_RE.search(message)
     if match:
         month = match.group(1)
         day = int(match.group(2))
         year = int(match.group(3))
-        month_map = {
-            "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6,
-            "july": 7, "august": 8, "september": 9, "october": 10, "november": 11, "december": 12
-        }
-        start_date = datetime(year, month_map[month.lower()], day, tzinfo=pytz.UTC)
+        start_date = datetime(year, _MONTH_MAP[month], day, tzinfo=UTC)
         end_date = start_date + timedelta(days=1)
     
-    if start_date and "afternoon" in message:
+    if start_date and flags & UserFlags.AFTERNOON:
         start_date = start_date.replace(hour=12, minute=0, second=0, microsecond=0)
         end_date = start_date.replace(hour=18, minute=0, second=0, microsecond=0)
-    elif "any slot" in message or "any time" in message or "whole day" in message or "all day" in message:
-        start_date = start_date.replace(hour=9, minute=0, second=0, microsecond=0) if start_date else (now + timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0, tzinfo=pytz.UTC)
-        end_date = start_date.replace(hour=18, minute=0, second=0, microsecond=0) if start_date else (now + timedelta(days=1)).replace(hour=18, minute=0, second=0, microsecond=0, tzinfo=pytz.UTC)
+    elif flags & UserFlags.WHOLE_DAY:
+        start_date = start_date.replace(hour=9, minute=0, second=0, microsecond=0) if start_date else (now + timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0, tzinfo=UTC)
+        end_date = start_date.replace(hour=18, minute=0, second=0, microsecond=0) if start_date else (now + timedelta(days=1)).replace(hour=18, minute=0, second=0, microsecond=0, tzinfo=UTC)
 
     return start_date, end_date
 
+def _match_hour(match: re.Match) -> int:
+    """Convert a _TIME_RE match to a 24-hour clock hour."""
+    hour = int(match.group(1))
+    meridian = match.group(3)
+    if meridian == "pm" and hour != 12:
+        hour += 12
+    elif meridian == "am" and hour == 12:
+        hour = 0
+    return hour
+
+async def _fetch_slots(message: str, flags: int) -> list[tuple[str, datetime]]:
+    """Fetch available slots for the day or week the message refers to, as (iso, IST datetime) pairs."""
+    start_date, end_date = parse_user_date(message, flags)
+    if not start_date:
+        start_date = (datetime.now(UTC) + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=UTC)
+        end_date = start_date + timedelta(days=7)
+
+    response = await _HTTP.request("GET", "/availability", params={
+        "start": start_date.astimezone(UTC).isoformat(),
+        "end": end_date.astimezone(UTC).isoformat()
+    })
+    response.raise_for_status()
+    slots = orjson.loads(response.content)["available_slots"]
+    # Parse each slot once; downstream nodes filter and format the cached datetimes
+    return [
+        (dt.isoformat(), dt)
+        for dt in (datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(IST) for slot in slots)
+    ]
+
 async def check_availability_node(state: AgentState) -> AgentState:
     """Check availability of slots for a specific day or week."""
-    time_zone = "Asia/Kolkata"
-    tz = pytz.timezone(time_zone)
     message = state["messages"][-1]["content"].strip().lower()
-    
-    start_date, end_date = parse_user_date(message)
-    if not start_date:
-        start_date = (datetime.now(pytz.UTC) + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=pytz.UTC)
-        end_date = start_date + timedelta(days=7)
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            start_str = start_date.astimezone(pytz.UTC).isoformat()
-            end_str = end_date.astimezone(pytz.UTC).isoformat()
-            response = await client.get(
-                f"{BACKEND_URL}/availability?start={start_str}&end={end_str}"
-            )
-            response.raise_for_status()
-            slots = response.json()["available_slots"]
-            state["suggested_slots"] = [
-                datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(tz).isoformat()
-                for slot in slots
-            ]
-            formatted_slots = [
-                datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(tz).strftime("%B %d, %Y, %I:%M %p")
-                for slot in slots[:5]
-            ]
-            state["messages"].append({"content": f"Available slots in Asia/Kolkata: {', '.join(formatted_slots)}", "role": "assistant"})
-            return state
-        except httpx.HTTPStatusError as e:
-            state["messages"].append({"error": f"Error checking availability: {str(e)}", "role": "assistant"})
-            return state
-
-async def suggest_slots(state: AgentState) -> AgentState:
+    task = state["pending_slots"] or asyncio.create_task(_fetch_slots(message, state["user_flags"]))
+    state["pending_slots"] = None
+
+    try:
+        state["suggested_slots"] = await task
+        state["slot_hours"] = np.fromiter((dt.hour for _, dt in state["suggested_slots"]), dtype=np.int8)
+        formatted_slots = [dt.strftime("%B %d, %Y, %I:%M %p") for _, dt in state["suggested_slots"][:5]]
+        state["messages"].append({"content": f"Available slots in Asia/Kolkata: {', '.join(formatted_slots)}", "role": "assistant"})
+        return state
+    except httpx.HTTPStatusError as e:
+        state["messages"].append({"error": f"Error checking availability: {str(e)}", "role": "assistant"})
+        return state
+
+async def suggest_slots(state: AgentState, config: RunnableConfig) -> AgentState:
     """Suggest available slots in Asia/Kolkata and handle greetings or time requests."""
     message = state["messages"][-1]["content"].strip().lower()
-    history = "\n".join(msg["content"] for msg in state["messages"][:-1])
+    history = state["history_str"]
     slots = state["suggested_slots"]
-    time_zone = "Asia/Kolkata"
-    tz = pytz.timezone(time_zone)
-    now = datetime.now(tz)
+    now = datetime.now(IST)
 
     # Handle basic greetings
-    greetings = ["hi", "hello", "hey"]
-    if any(greet in message for greet in greetings):
+    flags = state["user_flags"]
+    if flags & UserFlags.GREETING:
         state["messages"].append({"content": "Hi!", "role": "assistant"})
         return state
-    if "good morning" in message and now.hour < 12:
+    if flags & UserFlags.MORNING and now.hour < 12:
         state["messages"].append({"content": "Good morning!", "role": "assistant"})
         return state
 
@@ -197,71 +349,49 @@ async def suggest_slots(state: AgentState) -> AgentState:
         return state
 
     # Handle specific time requests (e.g., 4pm, 12pm, 7pm)
-    requested_hours = []
-    time_match = re.finditer(r'(\d{1,2})(?::(\d{2}))?\s*(am|pm)', message)
-    for match in time_match:
-        hour = int(match.group(1))
-        meridian = match.group(3)
-        if meridian == "pm" and hour != 12:
-            hour += 12
-        elif meridian == "am" and hour == 12:
-            hour = 0
-        requested_hours.append(hour)
+    requested_hours = {_match_hour(match) for match in _TIME_RE.finditer(message)}
 
     # Prioritize requested times
-    prioritized_slots = []
-    if requested_hours:
-        for slot in slots:
-            dt = datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(tz)
-            if dt.hour in requested_hours:
-                prioritized_slots.append(slot)
+    hours = state["slot_hours"]
+    prioritized = np.flatnonzero(np.isin(hours, np.fromiter(requested_hours, dtype=np.int8))) if requested_hours else []
 
     # If no exact matches or "anytime"/"whole day" requested, use all slots
-    filtered_slots = prioritized_slots if prioritized_slots else slots
-    if not prioritized_slots and ("anytime" in message or "whole day" in message or "all day" in message or "any slot" in message):
-        filtered_slots = [slot for slot in slots if 9 <= datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(tz).hour < 18]
+    filtered = prioritized if len(prioritized) else range(len(slots))
+    if not len(prioritized) and flags & UserFlags.ANYTIME:
+        filtered = np.flatnonzero((hours >= 9) & (hours < 18))
 
-    formatted_slots = [
-        datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(tz).strftime("%B %d, %Y, %I:%M %p")
-        for slot in filtered_slots[:5]
-    ]
+    formatted_slots = [slots[i][1].strftime("%B %d, %Y, %I:%M %p") for i in filtered[:5]]
 
     if not formatted_slots:
         state["messages"].append({"content": "No matching slots found. Would you like to see other time ranges?", "role": "assistant"})
         return state
 
     try:
-        response = llm.invoke(suggestion_prompt.format(message=message, slots=formatted_slots, history=history))
-        state["messages"].append({"content": response.content.strip(), "role": "assistant"})
+        reply = await _stream_reply(suggestion_prompt.format_messages(message=message, slots=formatted_slots, history=history), config)
+        state["messages"].append({"content": reply, "role": "assistant"})
     except Exception as e:
         state["messages"].append({"error": f"Error suggesting slots: {str(e)}. Please try again.", "role": "assistant"})
     return state
 
-async def confirm_booking(state: AgentState) -> AgentState:
+async def confirm_booking(state: AgentState, config: RunnableConfig) -> AgentState:
     """Confirm a booking in Asia/Kolkata."""
     message = state["messages"][-1]["content"].strip().lower()
     slots = state["suggested_slots"]
-    time_zone = "Asia/Kolkata"
-    tz = pytz.timezone(time_zone)
-    selected_slot = None
 
     # Try match slot by index (e.g., "1", "slot 2", "first")
-    for i, slot in enumerate(slots, 1):
-        if str(i) in message or f"slot {i}" in message or ("first" in message and i == 1):
-            selected_slot = slot
-            break
+    nums = {int(tok) for tok in _NUMBER_RE.findall(message)}
+    selected_slot = next((slot for i, slot in enumerate(slots, 1) if i in nums or ("first" in message and i == 1)), None)
 
     # Try match by specific time (e.g., "book at 2pm")
-    if not selected_slot:
-        try:
-            requested_time = parser.parse(message, fuzzy=True).time()
-            for slot in slots:
-                dt = datetime.fromisoformat(slot.replace('Z', '+00:00')).astimezone(tz)
-                if dt.hour == requested_time.hour and abs(dt.minute - requested_time.minute) <= 15:
-                    selected_slot = slot
-                    break
-        except Exception:
-            pass
+    time_match = _TIME_RE.search(message) if not selected_slot else None
+    if time_match:
+        hour = _match_hour(time_match)
+        minute = int(time_match.group(2) or 0)
+        for slot in slots:
+            dt = slot[1]
+            if dt.hour == hour and abs(dt.minute - minute) <= 15:
+                selected_slot = slot
+                break
 
     # Default fallback to first slot
     if not selected_slot and slots:
@@ -271,48 +401,45 @@ async def confirm_booking(state: AgentState) -> AgentState:
         state["messages"].append({"content": "No available slots to confirm. Please check availability first.", "role": "assistant"})
         return state
 
-    state["confirmed_slot"] = selected_slot
+    state["confirmed_slot"], start_time = selected_slot
 
     try:
-        formatted_slot = datetime.fromisoformat(selected_slot.replace('Z', '+00:00')).astimezone(tz).strftime("%B %d, %Y, %I:%M %p")
-        response = llm.invoke(confirmation_prompt.format(
+        formatted_slot = start_time.strftime("%B %d, %Y, %I:%M %p")
+        reply = await _stream_reply(confirmation_prompt.format_messages(
             slot=formatted_slot,
             selected_message=message,
-            history="\n".join(msg["content"] for msg in state["messages"][:-1])
-        ))
-        state["messages"].append({"content": response.content.strip(), "role": "assistant"})
+            history=state["history_str"]
+        ), config)
+        state["messages"].append({"content": reply, "role": "assistant"})
     except Exception as e:
         state["messages"].append({"error": f"Error confirming booking: {str(e)}. Please try again.", "role": "assistant"})
         return state
 
-    start_time = datetime.fromisoformat(selected_slot.replace('Z', '+00:00'))
     end_time = start_time + timedelta(minutes=30)
-    async with httpx.AsyncClient() as client:
-        try:
-            booking_request = {
-                "start_time": start_time.astimezone(pytz.UTC).isoformat(),
-                "end_time": end_time.astimezone(pytz.UTC).isoformat(),
-                "summary": "Meeting",
-                "description": "Booked via TailorTalk"
-            }
-            response = await client.post(f"{BACKEND_URL}/book", json=booking_request)
-            response.raise_for_status()
-            state["messages"].append({"content": f"Booking confirmed: {response.json()['message']}", "role": "assistant"})
-        except httpx.HTTPStatusError as e:
-            state["messages"].append({"error": f"Error booking appointment: {str(e)}", "role": "assistant"})
+    try:
+        booking_request = {
+            "start_time": start_time.astimezone(UTC).isoformat(),
+            "end_time": end_time.astimezone(UTC).isoformat(),
+            "summary": "Meeting",
+            "description": "Booked via TailorTalk"
+        }
+        response = await _HTTP.request("POST", "/book", content=orjson.dumps(booking_request), headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+        state["messages"].append({"content": f"Booking confirmed: {orjson.loads(response.content)['message']}", "role": "assistant"})
+    except httpx.HTTPStatusError as e:
+        state["messages"].append({"error": f"Error booking appointment: {str(e)}", "role": "assistant"})
 
     return state
 
 async def cancel_booking(state: AgentState) -> AgentState:
     """Handle cancellation of a booking in Asia/Kolkata."""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{BACKEND_URL}/upcoming-events")
-            response.raise_for_status()
-            state["events"] = response.json()["events"]
-        except httpx.HTTPStatusError as e:
-            state["messages"].append({"error": f"Error fetching upcoming events: {str(e)}", "role": "assistant"})
-            return state
+    try:
+        response = await _HTTP.request("GET", "/upcoming-events")
+        response.raise_for_status()
+        state["events"] = orjson.loads(response.content)["events"]
+    except httpx.HTTPStatusError as e:
+        state["messages"].append({"error": f"Error fetching upcoming events: {str(e)}", "role": "assistant"})
+        return state
     
     message = state["messages"][-1]["content"].strip().lower()
     events = state["events"]
@@ -320,38 +447,35 @@ async def cancel_booking(state: AgentState) -> AgentState:
         state["messages"].append({"content": "No upcoming bookings found.", "role": "assistant"})
         return state
     
-    tz = pytz.timezone("Asia/Kolkata")
     event_list = "\n".join([
-        f"{i+1}. {e['summary']} at {datetime.fromisoformat(e['start']['dateTime'].replace('Z', '+00:00')).astimezone(tz).strftime('%B %d, %Y, %I:%M %p')}"
+        f"{i+1}. {e['summary']} at {datetime.fromisoformat(e['start']['dateTime'].replace('Z', '+00:00')).astimezone(IST).strftime('%B %d, %Y, %I:%M %p')}"
         for i, e in enumerate(events)
     ])
-    if "select" not in message and not any(str(i+1) in message for i in range(len(events))):
+    nums = {int(tok) for tok in _NUMBER_RE.findall(message)}
+    selected = next((i for i in range(len(events)) if (i+1) in nums), None)
+    if "select" not in message and selected is None:
         state["messages"].append({"content": f"Please select an event to cancel:\n{event_list}", "role": "assistant"})
         return state
     
-    selected = None
-    for i in range(len(events)):
-        if str(i+1) in message:
-            selected = i
-            break
     if selected is None:
         state["messages"].append({"content": f"Please specify the event number to cancel:\n{event_list}", "role": "assistant"})
         return state
     
-    async with httpx.AsyncClient() as client:
-        try:
-            event_id = events[selected]['id']
-            event_time = datetime.fromisoformat(events[selected]['start']['dateTime'].replace('Z', '+00:00')).astimezone(tz).strftime("%B %d, %Y, %I:%M %p")
-            response = await client.delete(f"{BACKEND_URL}/cancel/{event_id}")
-            response.raise_for_status()
-            state["messages"].append({"content": f"Cancelled booking: {events[selected]['summary']} at {event_time}", "role": "assistant"})
-        except httpx.HTTPStatusError as e:
-            state["messages"].append({"error": f"Error cancelling booking: {str(e)}", "role": "assistant"})
+    try:
+        event_id = events[selected]['id']
+        event_time = datetime.fromisoformat(events[selected]['start']['dateTime'].replace('Z', '+00:00')).astimezone(IST).strftime("%B %d, %Y, %I:%M %p")
+        response = await _HTTP.request("DELETE", f"/cancel/{event_id}")
+        response.raise_for_status()
+        state["messages"].append({"content": f"Cancelled booking: {events[selected]['summary']} at {event_time}", "role": "assistant"})
+    except httpx.HTTPStatusError as e:
+        state["messages"].append({"error": f"Error cancelling booking: {str(e)}", "role": "assistant"})
     return state
 
 def route(state: AgentState) -> str:
     """Route to the appropriate node based on intent."""
     intent = state["intent"]
+    if intent not in ("book_appointment", "check_availability") and state["pending_slots"] is not None:
+        state["pending_slots"].cancel()
     if intent == "book_appointment":
         return "check_availability"
     elif intent == "check_availability":
@@ -415,28 +539,35 @@ async def main():
         with chat_container:
             st.chat_message("user").write(f"**You:** {prompt}", unsafe_allow_html=True)
         
+        with chat_container:
+            # Streaming nodes render into this bubble; it is overwritten with the final reply
+            reply_box = st.chat_message("assistant").empty()
+
         with st.spinner("Processing your request..."):
             try:
                 state = {
                     "messages": [{"content": msg["content"], "role": msg["role"]} for msg in st.session_state.messages],
                     "intent": "",
                     "suggested_slots": [],
+                    "slot_hours": np.empty(0, dtype=np.int8),
                     "confirmed_slot": "",
                     "time_zone": "Asia/Kolkata",
-                    "events": []
+                    "events": [],
+                    "pending_slots": None,
+                    "user_flags": _classify(IntentCache.normalize(prompt)),
+                    "history_str": "\n".join(msg["content"] for msg in st.session_state.messages[-HISTORY_LIMIT - 1:-1])
                 }
-                result = await graph.ainvoke(state)
+                result = await graph.ainvoke(state, config={"configurable": {"reply_box": reply_box}})
                 new_message = result["messages"][-1]
                 # Ensure the new message is always assigned the assistant role
                 new_message["role"] = "assistant"
                 st.session_state.messages.append(new_message)
-                with chat_container:
-                    st.chat_message("assistant").write(f"**AI:** {new_message['content']}", unsafe_allow_html=True)
+                reply_box.write(f"**AI:** {new_message['content']}", unsafe_allow_html=True)
             except Exception as e:
                 error_msg = {"content": f"Sorry, something went wrong: {str(e)}. Please try again.", "role": "assistant"}
                 st.session_state.messages.append(error_msg)
-                with chat_container:
-                    st.chat_message("assistant").write(f"**AI:** {error_msg['content']}", unsafe_allow_html=True)
+                reply_box.write(f"**AI:** {error_msg['content']}", unsafe_allow_html=True)
 
 if __name__ == "__main__":
+    # A fresh loop per run, closed when the run ends; only the backend client outlives it
     asyncio.run(main())
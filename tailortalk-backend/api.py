@@ -1,38 +1,68 @@
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request as GoogleRequest
-from datetime import datetime, timedelta
-import pytz
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from urllib.parse import quote
 from pydantic import BaseModel
+import asyncio
+import hashlib
+import httpx
+import numpy as np
+import orjson
 import os
 import logging
 import json
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from cachetools import TTLCache
 
 load_dotenv()
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+CALENDAR_API = "https://www.googleapis.com/calendar/v3"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled HTTP/2 client for every Calendar API call, reused across requests
+    app.state.http = httpx.AsyncClient(
+        base_url=CALENDAR_API,
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        timeout=10.0
+    )
+    # Load the OAuth token once so the first request doesn't pay for the Supabase read.
+    # Any failure (no token yet, Supabase down, revoked refresh token) must not stop the
+    # server from booting; requests retry the load and /oauth2callback stays reachable.
+    try:
+        await get_credentials()
+    except HTTPException as e:
+        logger.warning("Calendar credentials not loaded at startup: %s", e.detail)
+    except Exception as e:
+        logger.warning("Calendar credentials not loaded at startup: %s", e)
+    yield
+    await app.state.http.aclose()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Initialize Supabase client
 supabase: Client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
-# Print environment variables for debugging
-print(os.getenv("GOOGLE_CLIENT_ID"))
-print(os.getenv("GOOGLE_CLIENT_SECRET"))
-print(os.getenv("GOOGLE_REDIRECT_URI"))
+logger.debug("OAuth configured: %s", bool(os.getenv("GOOGLE_CLIENT_ID")))
 
 # CORS middleware to allow Streamlit frontend
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:8501", "https://*.streamlit.app"],
+    allow_origins=["http://localhost:8501"],
+    allow_origin_regex=r"https://.*\.streamlit\.app",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -41,20 +71,79 @@ app.add_middleware(
 # Google Calendar API setup
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+UTC = timezone.utc
+IST_OFFSET = timedelta(hours=5, minutes=30)  # Asia/Kolkata has no DST
+SLOT_SECONDS = 30 * 60
+BATCH_LIMIT = 50  # Google's recommended maximum number of calls per batch
+MAX_BATCH_ITEMS = 4 * BATCH_LIMIT  # largest /book-batch or /cancel-batch request accepted
+
+# Process-wide credentials; reloaded only on cold start, refreshed in place when expired
+_CREDS: Optional[Credentials] = None
+_CREDS_LOCK = asyncio.Lock()
+_BACKGROUND_TASKS: set = set()
+
+# Busy intervals keyed by (start, end) POSIX window; stale windows are dropped when the calendar changes
+_EVENTS: TTLCache = TTLCache(maxsize=512, ttl=30)
+
+# In-memory mirror of the calendar's timed events, kept current with Calendar sync tokens
+SYNC_LOOKBACK = timedelta(days=1)  # how far back the mirror reaches
+SYNC_HORIZON = timedelta(days=60)  # how far ahead a full sync lists
+_SYNC_LOCK = asyncio.Lock()
+_SYNC_TOKEN: Optional[str] = None
+# POSIX range covered by the mirror; windows outside it are listed directly
+_SYNC_FROM = 0
+_SYNC_UNTIL = 0
+_INTERVALS: dict = {}  # event id -> (start, end) POSIX seconds
+_INDEX: Optional[tuple] = None  # (starts, ends) sorted by start; rebuilt lazily after changes
+
 class BookingRequest(BaseModel):
     start_time: str
     end_time: str
     summary: str
     description: str
 
-def get_calendar_service(creds=None):
+async def get_credentials(creds=None) -> Credentials:
+    global _CREDS
     token_key = "default_user_token"  # Unique key for the token in Supabase
-    
-    if creds:
-        logger.info("Using provided credentials")
-    else:
+
+    # Fast path: a valid cached token needs neither the lock nor Supabase
+    if not creds and _CREDS is not None and _CREDS.valid:
+        return _CREDS
+
+    async with _CREDS_LOCK:
+        if creds:
+            logger.info("Using provided credentials")
+            _CREDS = creds
+        elif _CREDS is not None and _CREDS.valid:
+            # Another request finished loading or refreshing while we waited
+            return _CREDS
+        # Supabase reads and token refreshes both block
+        creds, refreshed = await asyncio.to_thread(_load_credentials, token_key)
+        if refreshed:
+            # The in-memory token is authoritative; persist it without holding up the request
+            task = asyncio.create_task(_save_token(token_key, creds.to_json()))
+            _BACKGROUND_TASKS.add(task)
+            task.add_done_callback(_BACKGROUND_TASKS.discard)
+        return creds
+
+async def _save_token(token_key: str, token: str) -> None:
+    """Write a refreshed token back to Supabase; failures are logged, not raised."""
+    try:
+        await asyncio.to_thread(lambda: supabase.table("tokens").update({"token": token}).eq("key", token_key).execute())
+    except Exception as e:
+        logger.error("Error saving refreshed token: %s", e)
+
+def _load_credentials(token_key: str) -> tuple[Credentials, bool]:
+    """Load or refresh the cached credentials, reporting whether they were refreshed.
+
+    Caller must hold _CREDS_LOCK.
+    """
+    global _CREDS
+    creds = cached = _CREDS
+    refreshed = False
+    if not creds:
         # Check Supabase for existing token
-        response = supabase.table("tokens").select("*").eq("key", token_key).execute()
+        response = supabase.table("tokens").select("token").eq("key", token_key).limit(1).execute()
         if response.data:
             logger.info("Loading credentials from Supabase")
             creds = Credentials.from_authorized_user_info(json.loads(response.data[0]["token"]), SCOPES)
@@ -62,9 +151,17 @@ def get_calendar_service(creds=None):
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             logger.info("Refreshing expired token")
-            creds.refresh(GoogleRequest())
-            # Update token in Supabase
-            supabase.table("tokens").update({"token": creds.to_json()}).eq("key", token_key).execute()
+            try:
+                creds.refresh(GoogleRequest())
+            except RefreshError:
+                # The refresh token was revoked or replaced. Drop the in-memory copy so this
+                # worker picks up a token re-authorized via /oauth2callback on any worker.
+                _CREDS = None
+                if creds is not cached:
+                    raise
+                logger.warning("Cached refresh token rejected, reloading from Supabase")
+                return _load_credentials(token_key)
+            refreshed = True
         else:
             logger.info("Initiating OAuth flow")
             client_config = {
@@ -81,146 +178,337 @@ def get_calendar_service(creds=None):
                 flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
                 flow.redirect_uri = os.getenv("GOOGLE_REDIRECT_URI")
                 auth_url, _ = flow.authorization_url(prompt='consent', access_type='offline')
-                logger.info(f"Please visit this URL to authorize the application: {auth_url}")
+                logger.warning("Please visit this URL to authorize the application: %s", auth_url)
                 raise HTTPException(
                     status_code=200,
                     detail=f"Please complete authorization by visiting: {auth_url}"
                 )
             except Exception as e:
-                logger.error(f"Error initiating OAuth flow: {str(e)}")
+                logger.error("Error initiating OAuth flow: %s", e)
                 raise HTTPException(status_code=500, detail=f"OAuth setup failed: {str(e)}")
     
-    service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
-    logger.info("Google Calendar service initialized")
-    return service
+    _CREDS = creds
+    return creds, refreshed
+
+async def _calendar(method: str, path: str, params: Optional[dict] = None, body: Optional[dict] = None) -> dict:
+    """Call the Calendar v3 REST API on the shared client and return the decoded JSON response."""
+    creds = await get_credentials()
+    headers = {"Authorization": f"Bearer {creds.token}"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    response = await app.state.http.request(
+        method, path, params=params, headers=headers,
+        content=orjson.dumps(body) if body is not None else None
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content) if response.content else {}
+
+def _event_path(event_id: str) -> str:
+    """Return the API path for one event, quoting the ID so it can't leave the events collection."""
+    # Dot segments survive quoting and would be resolved against the base URL
+    if event_id in ("", ".", ".."):
+        raise HTTPException(status_code=400, detail=f"Invalid event ID: {event_id!r}")
+    return f"/calendars/primary/events/{quote(event_id, safe='')}"
+
+def _available_slots(start_ts: int, end_ts: int, busy_starts: np.ndarray, busy_ends: np.ndarray, ist_offset: int) -> np.ndarray:
+    """Return POSIX start times of free 30-minute slots within 9 AM-6 PM IST.
+
+    busy_starts/busy_ends must be sorted by start.
+    """
+    slots = np.arange(start_ts, end_ts, SLOT_SECONDS, dtype=np.int64)
+    hours = (slots + ist_offset) // 3600 % 24
+    slots = slots[(hours >= 9) & (hours < 18)]
+    if not len(busy_starts):
+        return slots
+    # Events starting before a slot ends form a prefix of the sorted arrays; the slot is
+    # taken iff the latest end within that prefix is after the slot starts.
+    started = np.searchsorted(busy_starts, slots + SLOT_SECONDS, side='left')
+    latest_end = np.maximum.accumulate(busy_ends)
+    taken = (started > 0) & (latest_end[np.maximum(started - 1, 0)] > slots)
+    return slots[~taken]
+
+async def get_events_cached(start_time: datetime, end_time: datetime) -> tuple[np.ndarray, np.ndarray]:
+    """Return the window's busy (starts, ends) POSIX arrays sorted by start, cached for 30s."""
+    key = (int(start_time.timestamp()), int(end_time.timestamp()))
+    # A single lookup: an entry can expire between a membership test and the read
+    busy = _EVENTS.get(key)
+    if busy is not None:
+        logger.info("Using cached events")
+        return busy
+    await _sync_events()
+    if key[0] < _SYNC_FROM or key[1] > _SYNC_UNTIL:
+        busy = await _list_busy(start_time, end_time)
+    else:
+        starts, ends = _busy_index()
+        # Events starting before the window ends form a prefix; keep those still running at its start
+        i = np.searchsorted(starts, key[1], side='left')
+        overlapping = ends[:i] > key[0]
+        busy = (starts[:i][overlapping], ends[:i][overlapping])
+    _EVENTS[key] = busy
+    return busy
+
+async def _list_events(params: dict) -> tuple[list, Optional[str]]:
+    """Page through an events listing, returning its items and the final nextSyncToken."""
+    events = []
+    while True:
+        events_result = await _calendar("GET", "/calendars/primary/events", params=params)
+        events.extend(events_result.get('items', []))
+        if 'nextPageToken' not in events_result:
+            return events, events_result.get('nextSyncToken')
+        params['pageToken'] = events_result['nextPageToken']
+
+async def _list_busy(start_time: datetime, end_time: datetime) -> tuple[np.ndarray, np.ndarray]:
+    """List one window's busy intervals directly, for windows outside the synced range."""
+    events, _ = await _list_events({
+        'timeMin': start_time.isoformat(),
+        'timeMax': end_time.isoformat(),
+        'singleEvents': True,
+        'maxResults': 2500,
+        'fields': 'items(start/dateTime,end/dateTime),nextPageToken'
+    })
+    logger.info("Found %d events", len(events))
+    # Parse busy intervals once into parallel POSIX-second arrays for the vectorized sweep
+    timed = [event for event in events if 'dateTime' in event['start']]
+    starts = np.fromiter((datetime.fromisoformat(e['start']['dateTime']).timestamp() for e in timed), dtype=np.int64, count=len(timed))
+    ends = np.fromiter((datetime.fromisoformat(e['end']['dateTime']).timestamp() for e in timed), dtype=np.int64, count=len(timed))
+    order = np.argsort(starts, kind='stable')
+    return starts[order], ends[order]
+
+async def _sync_events() -> None:
+    """Apply calendar changes since the last sync to the event mirror.
+
+    The first call, any call after Google expires the token with 410 Gone, and any call
+    once less than half of SYNC_HORIZON is left ahead do a full listing from SYNC_LOOKBACK
+    ago to SYNC_HORIZON ahead; other calls fetch only the changed events.
+    """
+    global _SYNC_TOKEN, _SYNC_FROM, _SYNC_UNTIL, _INDEX
+    # syncToken can't be combined with timeMin/timeMax/orderBy, so the incremental request
+    # sends none of them. The full sync bounds its listing with both (so recurring events
+    # aren't expanded indefinitely); the token it returns may still report changes outside
+    # that range, which are discarded since windows outside it are never answered from here.
+    params = {
+        'singleEvents': True,
+        'maxResults': 2500,
+        'fields': 'items(id,status,start/dateTime,end/dateTime),nextPageToken,nextSyncToken'
+    }
+    async with _SYNC_LOCK:
+        now = datetime.now(UTC)
+        full = _SYNC_TOKEN is None or (now + SYNC_HORIZON / 2).timestamp() > _SYNC_UNTIL
+        if not full:
+            try:
+                events, token = await _list_events({**params, 'syncToken': _SYNC_TOKEN})
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 410:
+                    raise
+                logger.info("Sync token expired, running a full sync")
+                full = True
+        if full:
+            sync_from, sync_until = now - SYNC_LOOKBACK, now + SYNC_HORIZON
+            events, token = await _list_events({
+                **params, 'timeMin': sync_from.isoformat(), 'timeMax': sync_until.isoformat()
+            })
+            _INTERVALS.clear()
+            _SYNC_FROM, _SYNC_UNTIL = int(sync_from.timestamp()), int(sync_until.timestamp())
+        logger.info("Synced %d changed events", len(events))
+        changed = full
+        for event in events:
+            # Cancelled and all-day events don't block slots
+            if event.get('status') == 'cancelled' or 'dateTime' not in event.get('start', {}):
+                changed |= _INTERVALS.pop(event['id'], None) is not None
+                continue
+            start_ts = int(datetime.fromisoformat(event['start']['dateTime']).timestamp())
+            end_ts = int(datetime.fromisoformat(event['end']['dateTime']).timestamp())
+            if end_ts <= _SYNC_FROM or start_ts >= _SYNC_UNTIL:
+                changed |= _INTERVALS.pop(event['id'], None) is not None
+            else:
+                _INTERVALS[event['id']] = (start_ts, end_ts)
+                changed = True
+        # Slide the start of the mirror forward and evict events that ended before it
+        sync_from = int((now - SYNC_LOOKBACK).timestamp())
+        if sync_from > _SYNC_FROM:
+            _SYNC_FROM = sync_from
+            expired = [event_id for event_id, (_, end_ts) in _INTERVALS.items() if end_ts <= sync_from]
+            for event_id in expired:
+                del _INTERVALS[event_id]
+            changed |= bool(expired)
+        if changed:
+            _INDEX = None
+        _SYNC_TOKEN = token
+
+def _busy_index() -> tuple[np.ndarray, np.ndarray]:
+    """Return the mirrored intervals as (starts, ends) arrays sorted by start."""
+    global _INDEX
+    if _INDEX is None:
+        spans = np.fromiter(
+            (ts for span in _INTERVALS.values() for ts in span), dtype=np.int64, count=2 * len(_INTERVALS)
+        ).reshape(-1, 2)
+        order = np.argsort(spans[:, 0], kind='stable')
+        _INDEX = (spans[order, 0], spans[order, 1])
+    return _INDEX
+
+def _invalidate_events(event: Optional[dict] = None) -> None:
+    """Drop cached windows overlapping the event, or every window when it isn't known."""
+    if event is None:
+        _EVENTS.clear()
+        return
+    start_ts = datetime.fromisoformat(event['start']['dateTime']).timestamp()
+    end_ts = datetime.fromisoformat(event['end']['dateTime']).timestamp()
+    for key in [key for key in _EVENTS if key[0] < end_ts and key[1] > start_ts]:
+        _EVENTS.pop(key, None)
+
+def _cacheable_response(request: Request, data: dict) -> Response:
+    """Serialize data with an ETag, answering 304 when the client already holds this body."""
+    body = orjson.dumps(data)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=15"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/availability")
-async def get_availability(start: str = Query(...), end: str = Query(...)):
+async def get_availability(request: Request, start: datetime = Query(...), end: datetime = Query(...)):
     try:
-        logger.info(f"Received availability request: start={start}, end={end}")
-        start = start.replace(' ', '+').replace(' 00:00', '+00:00').strip()
-        end = end.replace(' ', '+').replace(' 00:00', '+00:00').strip()
-        try:
-            start_time = datetime.fromisoformat(start)
-            end_time = datetime.fromisoformat(end)
-        except ValueError as e:
-            logger.error(f"Invalid datetime format: {str(e)}, start={start}, end={end}")
-            raise HTTPException(status_code=400, detail=f"Invalid datetime format: {str(e)}")
-        if start_time.tzinfo is None:
-            start_time = start_time.replace(tzinfo=pytz.UTC)
-        if end_time.tzinfo is None:
-            end_time = end_time.replace(tzinfo=pytz.UTC)
-        logger.info(f"Parsed start_time: {start_time.isoformat()}, end_time: {end_time.isoformat()}")
+        logger.info("Received availability request: start=%s, end=%s", start, end)
+        start_time = start if start.tzinfo is not None else start.replace(tzinfo=UTC)
+        end_time = end if end.tzinfo is not None else end.replace(tzinfo=UTC)
         if start_time >= end_time:
             raise HTTPException(status_code=400, detail="start_time must be before end_time")
-        tz = pytz.timezone('Asia/Kolkata')
-        start_ist = start_time.astimezone(tz)
-        end_ist = end_time.astimezone(tz)
-        service = get_calendar_service()
-        events_result = service.events().list(
-            calendarId='primary',
-            timeMin=start_time.isoformat(),
-            timeMax=end_time.isoformat(),
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
-        logger.info(f"Found {len(events)} events")
-        busy_slots = [
-            {
-                'start': event['start'].get('dateTime'),
-                'end': event['end'].get('dateTime')
-            }
-            for event in events
-        ]
-        available_slots = []
-        current_time = start_time
-        while current_time < end_time:
-            slot_end = current_time + timedelta(minutes=30)
-            current_time_ist = current_time.astimezone(tz)
-            if 9 <= current_time_ist.hour < 18:
-                if not any(
-                    datetime.fromisoformat(slot['start'].replace('Z', '+00:00')) < slot_end and
-                    datetime.fromisoformat(slot['end'].replace('Z', '+00:00')) > current_time
-                    for slot in busy_slots
-                ):
-                    available_slots.append(current_time.isoformat())
-            current_time = slot_end
-        logger.info(f"Returning {len(available_slots)} available slots")
-        return {"available_slots": available_slots}
+        busy_starts, busy_ends = await get_events_cached(start_time, end_time)
+        free = _available_slots(
+            int(start_time.timestamp()),
+            int(end_time.timestamp()),
+            busy_starts,
+            busy_ends,
+            int(IST_OFFSET.total_seconds())
+        )
+        available_slots = [datetime.fromtimestamp(ts, UTC).isoformat() for ts in free.tolist()]
+        logger.info("Returning %d available slots", len(available_slots))
+        return _cacheable_response(request, {"available_slots": available_slots})
     except HTTPException as e:
         raise e
     except Exception as e:
-        logger.error(f"Error in get_availability: {str(e)}")
+        logger.error("Error in get_availability: %s", e)
         raise HTTPException(status_code=500, detail=f"Error fetching availability: {str(e)}")
 
+def _booking_event(booking: BookingRequest) -> dict:
+    """Validate a booking request and build the Calendar event body for it."""
+    start_time = datetime.fromisoformat(booking.start_time)
+    end_time = datetime.fromisoformat(booking.end_time)
+    if start_time.tzinfo is None:
+        start_time = start_time.replace(tzinfo=UTC)
+    if end_time.tzinfo is None:
+        end_time = end_time.replace(tzinfo=UTC)
+    if start_time >= end_time:
+        raise HTTPException(status_code=400, detail="start_time must be before end_time")
+    return {
+        'summary': booking.summary,
+        'description': booking.description,
+        'start': {
+            'dateTime': start_time.isoformat(),
+            'timeZone': 'UTC',
+        },
+        'end': {
+            'dateTime': end_time.isoformat(),
+            'timeZone': 'UTC',
+        },
+    }
+
+def _check_batch_size(items: list) -> None:
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_ITEMS} items per batch")
+
+async def _run_batched(calls: list) -> list:
+    """Await Calendar calls BATCH_LIMIT at a time, returning each result or exception in order.
+
+    The calls share the pooled HTTP/2 connection, so each chunk costs roughly one round-trip.
+    """
+    results = []
+    for i in range(0, len(calls), BATCH_LIMIT):
+        results += await asyncio.gather(*calls[i:i + BATCH_LIMIT], return_exceptions=True)
+    return results
+
 @app.post("/book")
 async def book_appointment(booking: BookingRequest):
     try:
-        logger.info(f"Booking appointment: {booking}")
-        start_time = datetime.fromisoformat(booking.start_time.replace('Z', '+00:00'))
-        end_time = datetime.fromisoformat(booking.end_time.replace('Z', '+00:00'))
-        if start_time.tzinfo is None:
-            start_time = start_time.replace(tzinfo=pytz.UTC)
-        if end_time.tzinfo is None:
-            end_time = end_time.replace(tzinfo=pytz.UTC)
-        if start_time >= end_time:
-            raise HTTPException(status_code=400, detail="start_time must be before end_time")
-        service = get_calendar_service()
-        event = {
-            'summary': booking.summary,
-            'description': booking.description,
-            'start': {
-                'dateTime': start_time.isoformat(),
-                'timeZone': 'UTC',
-            },
-            'end': {
-                'dateTime': end_time.isoformat(),
-                'timeZone': 'UTC',
-            },
-        }
-        event = service.events().insert(calendarId='primary', body=event).execute()
-        logger.info(f"Event created: {event.get('htmlLink')}")
+        logger.info("Booking appointment: %s", booking)
+        event = _booking_event(booking)
+        event = await _calendar("POST", "/calendars/primary/events", body=event)
+        _invalidate_events(event)
+        logger.info("Event created: %s", event.get('htmlLink'))
         return {"message": f"Event created: {event.get('htmlLink')}"}
     except ValueError as e:
-        logger.error(f"Invalid datetime format: {str(e)}")
+        logger.error("Invalid datetime format: %s", e)
         raise HTTPException(status_code=400, detail=f"Invalid datetime format: {str(e)}")
     except Exception as e:
-        logger.error(f"Error in book_appointment: {str(e)}")
+        logger.error("Error in book_appointment: %s", e)
         raise HTTPException(status_code=500, detail=f"Error booking appointment: {str(e)}")
 
+@app.post("/book-batch")
+async def book_appointments(bookings: List[BookingRequest]):
+    _check_batch_size(bookings)
+    try:
+        logger.info("Booking %d appointments", len(bookings))
+        events = [_booking_event(booking) for booking in bookings]
+    except ValueError as e:
+        logger.error("Invalid datetime format: %s", e)
+        raise HTTPException(status_code=400, detail=f"Invalid datetime format: {str(e)}")
+    results = await _run_batched([_calendar("POST", "/calendars/primary/events", body=event) for event in events])
+    for event, r in zip(events, results):
+        if not isinstance(r, Exception):
+            _invalidate_events(event)
+    return {"results": [
+        {"error": f"Error booking appointment: {str(r)}"} if isinstance(r, Exception)
+        else {"message": f"Event created: {r.get('htmlLink')}"}
+        for r in results
+    ]}
+
 @app.get("/upcoming-events")
-async def get_upcoming_events():
+async def get_upcoming_events(request: Request):
     try:
         logger.info("Fetching upcoming events")
-        service = get_calendar_service()
-        now = datetime.now(pytz.UTC)
-        events_result = service.events().list(
-            calendarId='primary',
-            timeMin=now.isoformat(),
-            maxResults=10,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
+        now = datetime.now(UTC)
+        events_result = await _calendar("GET", "/calendars/primary/events", params={
+            'timeMin': now.isoformat(),
+            'maxResults': 10,
+            'singleEvents': True,
+            'orderBy': 'startTime'
+        })
         events = events_result.get('items', [])
-        logger.info(f"Found {len(events)} upcoming events")
-        return {"events": events}
+        logger.info("Found %d upcoming events", len(events))
+        return _cacheable_response(request, {"events": events})
     except Exception as e:
-        logger.error(f"Error in get_upcoming_events: {str(e)}")
+        logger.error("Error in get_upcoming_events: %s", e)
         raise HTTPException(status_code=500, detail=f"Error fetching events: {str(e)}")
 
 @app.delete("/cancel/{event_id}")
 async def cancel_event(event_id: str):
     try:
-        logger.info(f"Cancelling event: {event_id}")
-        service = get_calendar_service()
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
+        logger.info("Cancelling event: %s", event_id)
+        await _calendar("DELETE", _event_path(event_id))
+        # DELETE doesn't return the event's window, so drop every cached one
+        _invalidate_events()
         logger.info("Event cancelled")
         return {"message": "Event cancelled"}
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        logger.error(f"Error in cancel_event: {str(e)}")
+        logger.error("Error in cancel_event: %s", e)
         raise HTTPException(status_code=500, detail=f"Error cancelling event: {str(e)}")
 
+@app.post("/cancel-batch")
+async def cancel_events(event_ids: List[str]):
+    _check_batch_size(event_ids)
+    logger.info("Cancelling %d events", len(event_ids))
+    # Validate every ID before any call is created
+    paths = [_event_path(event_id) for event_id in event_ids]
+    results = await _run_batched([_calendar("DELETE", path) for path in paths])
+    _invalidate_events()
+    return {"results": [
+        {"error": f"Error cancelling event: {str(r)}"} if isinstance(r, Exception)
+        else {"message": "Event cancelled"}
+        for r in results
+    ]}
+
 @app.get("/oauth2callback")
 async def oauth2callback(request: Request):
     token_key = "default_user_token"
@@ -243,16 +531,17 @@ async def oauth2callback(request: Request):
         if not code:
             raise HTTPException(status_code=400, detail="Missing code parameter")
         
-        flow.fetch_token(code=code)
+        await asyncio.to_thread(flow.fetch_token, code=code)
         creds = flow.credentials
+        await get_credentials(creds)
         
         # Store token in Supabase
-        supabase.table("tokens").upsert({
+        await asyncio.to_thread(lambda: supabase.table("tokens").upsert({
             "key": token_key,
             "token": creds.to_json()
-        }).execute()
+        }).execute())
         
         return {"message": "OAuth callback successful, token saved in Supabase"}
     except Exception as e:
-        logger.error(f"Error in OAuth callback: {str(e)}")
+        logger.error("Error in OAuth callback: %s", e)
         raise HTTPException(status_code=500, detail=f"Error in OAuth callback: {str(e)}")
\ No newline at end of file